@@ -1,4 +1,7 @@
-import asyncio
+import httpx
+import uvloop
+from os import getenv
+from openai import AsyncOpenAI
 from src.evaluate import (
     load_tasks,
     evaluate_agent_multiple_tasks,
@@ -9,8 +12,23 @@ from src.evaluate import (
 
 def main():
     tasks: list[Task] = load_tasks()
-    evaluation_results = asyncio.run(
-        evaluate_agent_multiple_tasks(tasks, max_run_in_parallel=256)
+    # a single client shared by all the agents so that connections are reused across tasks
+    # the client retries rate limit, timeout, connection and server errors with exponential backoff
+    # the timeout is passed to the client and not only to the http client because the client overrides it on every request
+    openai_client = AsyncOpenAI(
+        api_key=getenv("OPENAI_API_KEY"),
+        max_retries=6,
+        timeout=httpx.Timeout(60.0, connect=10.0),
+        http_client=httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=1024, max_keepalive_connections=1024),
+            timeout=httpx.Timeout(60.0, connect=10.0),
+        ),
+    )
+    # uvloop is a faster drop in replacement for the asyncio event loop, which helps with the many subprocess pipes and http connections
+    evaluation_results = uvloop.run(
+        evaluate_agent_multiple_tasks(
+            tasks, openai_client=openai_client, max_run_in_parallel=256
+        )
     )
     print_evaluation_results(evaluation_results)
 
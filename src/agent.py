@@ -1,18 +1,49 @@
-from openai import AsyncOpenAI
+from openai import AsyncOpenAI, BadRequestError, NotFoundError, NOT_GIVEN
+import asyncio
+from asyncio import Semaphore
+from contextlib import nullcontext
 from typing import Any
+import logging
+from collections import OrderedDict
+import hashlib
 import inspect
 from inspect import signature
-import json
+import orjson
 from dataclasses import dataclass, field
 from abc import ABC, abstractmethod
-from openai.types.chat import ChatCompletionMessage
-from beartype import beartype
+from openai.types.chat import ChatCompletionMessage, ChatCompletionMessageToolCall
+from openai.types.chat.chat_completion_message_tool_call import Function
+from openai.types.responses import Response
+from src.type_checking import beartype
 
 from src.sandbox import DockerSandbox
 
+logger = logging.getLogger(__name__)
 
-@beartype
+# responses shared between all agents, keyed by a hash of the model, tools and conversation
+# many agents running the same tasks send the same requests, at least in the first turns
+# the values are futures so that concurrent identical requests wait for the one in flight instead of all missing the cache
+# a future's result is None if its request failed, in which case the waiting agents send the request themselves
+_response_cache: OrderedDict[bytes, asyncio.Future] = OrderedDict()
+_RESPONSE_CACHE_MAX_SIZE = 4096
+
+
+# not type checked because Tool.call is on the hot path and already validates the arguments against the signature of _call
 class Tool(ABC):
+    _required_arguments: frozenset[str] = frozenset()
+    _allowed_arguments: frozenset[str] = frozenset()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # skip the self parameter of the unbound method
+        parameters = list(signature(cls._call).parameters.values())[1:]
+        cls._required_arguments = frozenset(
+            param.name
+            for param in parameters
+            if param.default == inspect.Parameter.empty
+        )
+        cls._allowed_arguments = frozenset(param.name for param in parameters)
+
     @abstractmethod
     def description_for_openai_api(self) -> dict:
         pass
@@ -23,29 +54,16 @@ class Tool(ABC):
 
     async def call(self, json_arguments: str) -> str | None:
         try:
-            arguments = json.loads(json_arguments)
-        except json.JSONDecodeError:
+            arguments = orjson.loads(json_arguments)
+        except orjson.JSONDecodeError:
             return None
 
         if not isinstance(arguments, dict):
             return None
 
-        required_arguments = [
-            arg
-            for arg, param in signature(self._call).parameters.items()
-            if param.default == inspect.Parameter.empty
-        ]
-        optional_arguments = [
-            arg
-            for arg, param in signature(self._call).parameters.items()
-            if param.default != inspect.Parameter.empty
-        ]
-
-        if not (set(required_arguments) <= set(arguments.keys())):
-            return None
-
         if not (
-            set(arguments.keys()) <= set(required_arguments) | set(optional_arguments)
+            arguments.keys() >= self._required_arguments
+            and arguments.keys() <= self._allowed_arguments
         ):
             return None
 
@@ -95,29 +113,22 @@ class BashTool(Tool):
         if self.verbose:
             print("\033[1;31mRUNNING COMMAND:\033[0m", command)
 
-        result = await self.sandbox.run_command(command)
+        result = await self.sandbox.run_command(
+            command, max_output_length=self.max_output_length
+        )
 
         if self.verbose:
             print(f"\033[1;31mEXIT CODE: {result.returncode}\033[0m")
             print("\033[1;31mSTDOUT:\033[0m", result.stdout)
             print("\033[1;31mSTDOUT:\033[0m", result.stderr)
 
-        return json.dumps(
+        return orjson.dumps(
             {
                 "exit_code": result.returncode,
-                "stdout": self._truncate(result.stdout),
-                "stderr": self._truncate(result.stderr),
+                "stdout": result.stdout,
+                "stderr": result.stderr,
             }
-        )
-
-    def _truncate(self, text: str) -> str:
-        if len(text) <= self.max_output_length:
-            return text
-        return (
-            text[: self.max_output_length // 2]
-            + "[TRUNCATED]"
-            + text[-self.max_output_length // 2 :]
-        )
+        ).decode()
 
 
 @beartype
@@ -130,17 +141,52 @@ class Agent:
     system_message: str | None = (
         "You are an agent that can call tools to complete a task. You are very thorough and do never give up. If something doesn't work, you make the changes that make are most likely to make it work and keep trying until it works. There is no human in the loop, so you cannot ask for help or ask for clarification. Before you call the finish tool, you must checked whether you have completed the task successfully. If it turns out that what you did failed complete the task, you should retry completing the task and not call the finish tool. When you are sure that you have completed the task successfully, call the finish tool."
     )
+    # shared between agents to cap the number of concurrent openai requests independently of the number of concurrent agents
+    openai_semaphore: Semaphore | None = None
+    # with the responses api, the conversation is kept on the server and only the new messages are sent each turn
+    use_responses_api: bool = True
+    # caching responses only makes sense if they are deterministic, so this also sets the temperature to 0 (and the seed with chat completions)
+    cache_responses: bool = False
+    _tool_schemas: list[dict] = field(init=False, repr=False)
+    _responses_api_tool_schemas: list[dict] = field(init=False, repr=False)
+    _tools_by_name: dict[str, Tool] = field(init=False, repr=False)
+    _responses_api_works: bool = field(init=False, repr=False)
+    _last_response_id: str | None = field(init=False, repr=False, default=None)
+    _n_messages_sent: int = field(init=False, repr=False, default=0)
 
     def __post_init__(self):
         if not any(isinstance(tool, FinishTool) for tool in self.tools):
             self.tools.append(FinishTool())
 
+        self._tool_schemas = [tool.description_for_openai_api() for tool in self.tools]
+        self._tools_by_name = {
+            schema["function"]["name"]: tool
+            for schema, tool in zip(self._tool_schemas, self.tools)
+        }
+        # unlike the chat completions api, the responses api doesn't accept null parameters
+        self._responses_api_tool_schemas = [
+            {
+                "type": "function",
+                "strict": False,
+                **schema["function"],
+                "parameters": schema["function"]["parameters"]
+                or {"type": "object", "properties": {}},
+            }
+            for schema in self._tool_schemas
+        ]
+
     async def run(self, prompt: str) -> None:
-        conversation = [{"role": "user", "content": prompt}]
+        # the system message comes first so that the prompt prefix is the same across turns and tasks, which lets the api cache it
+        conversation = []
+        self._responses_api_works = self.use_responses_api
+        self._last_response_id = None
+        self._n_messages_sent = 0
 
         if self.system_message is not None:
             conversation.append({"role": "system", "content": self.system_message})
 
+        conversation.append({"role": "user", "content": prompt})
+
         for _ in range(self.max_turns):
             response = await self._chatbot_response(conversation)
 
@@ -150,7 +196,6 @@ class Agent:
                 assert (
                     response.content is not None
                 )  # this assert cannot be triggered, right?
-                conversation.append({"role": "assistant", "content": response.content})
                 conversation.append(
                     {
                         "role": "user",
@@ -162,15 +207,7 @@ class Agent:
             finished = False
 
             for tool_call in response.tool_calls:
-                tool = next(
-                    (
-                        tool
-                        for tool in self.tools
-                        if tool.description_for_openai_api()["function"]["name"]
-                        == tool_call.function.name
-                    ),
-                    None,
-                )
+                tool = self._tools_by_name.get(tool_call.function.name)
                 assert tool is not None  # this assert cannot be triggered, right?
 
                 if isinstance(tool, FinishTool):
@@ -179,10 +216,13 @@ class Agent:
                     break
 
                 returned = await tool.call(tool_call.function.arguments)
+                # tool calls already return json, except for None when the arguments are invalid
+                if returned is None:
+                    returned = orjson.dumps(returned).decode()
                 conversation.append(
                     {
                         "role": "tool",
-                        "content": json.dumps(returned),
+                        "content": returned,
                         "tool_call_id": tool_call.id,
                     }
                 )
@@ -193,9 +233,145 @@ class Agent:
     async def _chatbot_response(
         self, conversation: list[dict | ChatCompletionMessage]
     ) -> ChatCompletionMessage:
-        response = await self.openai_client.chat.completions.create(
+        if not self.cache_responses:
+            return await self._uncached_chatbot_response(conversation)
+
+        key = self._response_cache_key(conversation)
+        if key in _response_cache:
+            _response_cache.move_to_end(key)
+            # shielded so that cancelling this agent doesn't cancel the request other agents are waiting on
+            cached_response = await asyncio.shield(_response_cache[key])
+            if cached_response is None:
+                return await self._chatbot_response(conversation)
+            # the server doesn't know about this response, so the whole conversation has to be sent on the next turn
+            self._last_response_id = None
+            return cached_response.model_copy(deep=True)
+
+        future = asyncio.get_running_loop().create_future()
+        _response_cache[key] = future
+        if len(_response_cache) > _RESPONSE_CACHE_MAX_SIZE:
+            _response_cache.popitem(last=False)
+
+        try:
+            response = await self._uncached_chatbot_response(conversation)
+        except BaseException:
+            if _response_cache.get(key) is future:
+                del _response_cache[key]
+            future.set_result(None)
+            raise
+
+        future.set_result(response.model_copy(deep=True))
+        return response
+
+    def _response_cache_key(
+        self, conversation: list[dict | ChatCompletionMessage]
+    ) -> bytes:
+        request = {
+            "model": self.model,
+            "messages": [
+                (
+                    message.model_dump(exclude_none=True)
+                    if isinstance(message, ChatCompletionMessage)
+                    else message
+                )
+                for message in conversation
+            ],
+            "tools": self._tool_schemas,
+        }
+        return hashlib.blake2b(
+            orjson.dumps(request, option=orjson.OPT_SORT_KEYS, default=str),
+            digest_size=16,
+        ).digest()
+
+    async def _uncached_chatbot_response(
+        self, conversation: list[dict | ChatCompletionMessage]
+    ) -> ChatCompletionMessage:
+        async with self.openai_semaphore or nullcontext():
+            if self._responses_api_works:
+                try:
+                    return await self._responses_api_response(conversation)
+                except (BadRequestError, NotFoundError) as e:
+                    # e.g. the model doesn't support the responses api, send the whole conversation to the chat completions api from now on
+                    logger.warning(
+                        "Responses API request failed, falling back to the chat completions API: %s",
+                        e,
+                    )
+                    self._responses_api_works = False
+
+            response = await self.openai_client.chat.completions.create(
+                model=self.model,
+                messages=conversation,
+                tools=self._tool_schemas,
+                temperature=0 if self.cache_responses else NOT_GIVEN,
+                seed=0 if self.cache_responses else NOT_GIVEN,
+            )
+        return response.choices[0].message
+
+    async def _responses_api_response(
+        self, conversation: list[dict | ChatCompletionMessage]
+    ) -> ChatCompletionMessage:
+        new_messages = (
+            conversation[self._n_messages_sent :]
+            if self._last_response_id is not None
+            else conversation
+        )
+        response = await self.openai_client.responses.create(
             model=self.model,
-            messages=conversation,
-            tools=[tool.description_for_openai_api() for tool in self.tools],
+            input=[
+                item
+                for message in new_messages
+                for item in _to_responses_api_input(message)
+            ],
+            tools=self._responses_api_tool_schemas,
+            previous_response_id=self._last_response_id or NOT_GIVEN,
+            temperature=0 if self.cache_responses else NOT_GIVEN,
         )
-        return response.choices[0].message
+        self._last_response_id = response.id
+        # + 1 because run appends the response to the conversation
+        self._n_messages_sent = len(conversation) + 1
+        return _from_responses_api_output(response)
+
+
+def _to_responses_api_input(message: dict | ChatCompletionMessage) -> list[dict]:
+    if isinstance(message, ChatCompletionMessage):
+        items = []
+        if message.content is not None:
+            items.append({"role": "assistant", "content": message.content})
+        for tool_call in message.tool_calls or []:
+            items.append(
+                {
+                    "type": "function_call",
+                    "call_id": tool_call.id,
+                    "name": tool_call.function.name,
+                    "arguments": tool_call.function.arguments,
+                }
+            )
+        return items
+
+    if message["role"] == "tool":
+        return [
+            {
+                "type": "function_call_output",
+                "call_id": message["tool_call_id"],
+                "output": message["content"],
+            }
+        ]
+
+    return [{"role": message["role"], "content": message["content"]}]
+
+
+def _from_responses_api_output(response: Response) -> ChatCompletionMessage:
+    tool_calls = [
+        ChatCompletionMessageToolCall(
+            id=item.call_id,
+            type="function",
+            function=Function(name=item.name, arguments=item.arguments),
+        )
+        for item in response.output
+        if item.type == "function_call"
+    ]
+    return ChatCompletionMessage(
+        role="assistant",
+        content=response.output_text or None,
+        tool_calls=tool_calls or None,
+    )
@@ -1,13 +1,15 @@
 import asyncio
+import shlex
+from collections import Counter
 from openai import AsyncOpenAI
 from tabulate import tabulate
 from pathlib2 import Path
-from os import getenv
-import json
+import orjson
+import xml.etree.ElementTree as ElementTree
 from dataclasses import dataclass
-from beartype import beartype
+from src.type_checking import beartype
 from tqdm.asyncio import tqdm
-from src.sandbox import DockerSandbox
+from src.sandbox import DockerSandbox, SANDBOX_HOME
 from src.agent import Agent, BashTool
 
 
@@ -28,33 +30,52 @@ class EvaluationResult:
 
 
 async def evaluate_agent(
-    task: Task, model: str = "gpt-4o-mini", max_turns: int = 15
+    task: Task,
+    openai_client: AsyncOpenAI,
+    model: str = "gpt-4o-mini",
+    max_turns: int = 15,
+    openai_semaphore: asyncio.Semaphore | None = None,
+    cache_responses: bool = False,
 ) -> EvaluationResult:
     async with DockerSandbox() as sandbox:
         agent = Agent(
             model=model,
-            openai_client=AsyncOpenAI(api_key=getenv("OPENAI_API_KEY")),
+            openai_client=openai_client,
             tools=[BashTool(sandbox)],
             max_turns=max_turns,
+            openai_semaphore=openai_semaphore,
+            cache_responses=cache_responses,
         )
 
         await agent.run(task.description)
 
-        await sandbox.run_command(
-            f"cat << EOF > public_tests.py\n{task.public_tests}\nEOF"
+        try:
+            await asyncio.gather(
+                sandbox.write_file("public_tests.py", task.public_tests.encode()),
+                sandbox.write_file("private_tests.py", task.private_tests.encode()),
+            )
+        except Exception:
+            # e.g. the container is gone, this shouldn't abort the evaluation of the other tasks
+            return EvaluationResult(
+                public_tests_passed=False, private_tests_passed=False
+            )
+
+        # the tests are run in a fresh shell so that the shell state the agent left behind (e.g. set -e or a pytest function) can't affect grading
+        await sandbox.stop_shell()
+
+        # both test files are run with a single pytest invocation and the results are split per file using the junit xml report
+        # the cd is explicit so that the tests run where write_file wrote them
+        tests_completed_process = await sandbox.run_command(
+            "rm -f /tmp/test_results.xml"
+            f" && cd {shlex.quote(SANDBOX_HOME)}"
+            " && { pytest public_tests.py private_tests.py -p no:cacheprovider --continue-on-collection-errors --junitxml=/tmp/test_results.xml > /dev/null 2>&1;"
+            " cat /tmp/test_results.xml; }",
+            # each test file used to be run with its own 30 second timeout
+            timeout_seconds=60,
         )
-        public_tests_completed_process = await sandbox.run_command(
-            "pytest public_tests.py"
-        )
-        public_tests_passed = public_tests_completed_process.returncode == 0
-
-        await sandbox.run_command(
-            f"cat << EOF > private_tests.py\n{task.private_tests}\nEOF"
-        )
-        private_tests_completed_process = await sandbox.run_command(
-            "pytest private_tests.py"
-        )
-        private_tests_passed = private_tests_completed_process.returncode == 0
+        tests_passed = tests_passed_per_module(tests_completed_process.stdout)
+        public_tests_passed = tests_passed.get("public_tests", False)
+        private_tests_passed = tests_passed.get("private_tests", False)
 
         return EvaluationResult(
             public_tests_passed=public_tests_passed,
@@ -62,21 +83,54 @@ async def evaluate_agent(
         )
 
 
+@beartype
+def tests_passed_per_module(junit_xml: str) -> dict[str, bool]:
+    # a module passed if it has at least one test and none of its tests failed or errored, as with pytest's exit code
+    try:
+        root = ElementTree.fromstring(junit_xml)
+    except ElementTree.ParseError:
+        return {}
+
+    passed = {}
+    for testcase in root.iter("testcase"):
+        # collection errors have an empty classname and the module as name
+        module = testcase.get("classname", "").split(".")[0] or testcase.get("name")
+        failed = (
+            testcase.find("failure") is not None or testcase.find("error") is not None
+        )
+        passed[module] = passed.get(module, True) and not failed
+    return passed
+
+
 @beartype
 async def evaluate_agent_multiple_tasks(
     tasks: list[Task],
+    openai_client: AsyncOpenAI,
     model: str = "gpt-4o-mini",
     max_turns: int = 15,
     max_run_in_parallel: int = 64,
+    max_openai_requests_in_parallel: int = 64,
+    cache_responses: bool = False,
 ) -> dict[Task, EvaluationResult]:
     semaphore = asyncio.Semaphore(max_run_in_parallel)
+    openai_semaphore = asyncio.Semaphore(max_openai_requests_in_parallel)
 
     async def evaluate_one(*args, **kwargs):
         async with semaphore:
             return await evaluate_agent(*args, **kwargs)
 
     results = await tqdm.gather(
-        *[evaluate_one(task=task, model=model, max_turns=max_turns) for task in tasks],
+        *[
+            evaluate_one(
+                task=task,
+                openai_client=openai_client,
+                model=model,
+                max_turns=max_turns,
+                openai_semaphore=openai_semaphore,
+                cache_responses=cache_responses,
+            )
+            for task in tasks
+        ],
         desc="running evals",
     )
 
@@ -92,29 +146,24 @@ def print_evaluation_results(evaluation_results: dict[Task, EvaluationResult]) -
         "private passed",
         "both passed",
     ]
-    table = []
-    task_categories = list(set(task.category for task in evaluation_results.keys()))
-    for task_category in task_categories:
-        table.append(
-            [task_category]
-            + [
-                len(
-                    [
-                        task
-                        for task, result in evaluation_results.items()
-                        if task.category == task_category
-                        and result.private_tests_passed == private_passed
-                        and result.public_tests_passed == public_passed
-                    ]
-                )
-                for private_passed, public_passed in [
-                    (False, False),
-                    (False, True),
-                    (True, False),
-                    (True, True),
-                ]
+    counts = Counter(
+        (task.category, result.private_tests_passed, result.public_tests_passed)
+        for task, result in evaluation_results.items()
+    )
+    task_categories = sorted(set(task.category for task in evaluation_results.keys()))
+    table = [
+        [task_category]
+        + [
+            counts[(task_category, private_passed, public_passed)]
+            for private_passed, public_passed in [
+                (False, False),
+                (False, True),
+                (True, False),
+                (True, True),
             ]
-        )
+        ]
+        for task_category in task_categories
+    ]
     print(tabulate(table, headers=headers))
 
 
@@ -124,8 +173,8 @@ def load_tasks() -> list[Task]:
     tasks = []
 
     for task_file in tasks_dir.glob("*.json"):
-        with open(task_file) as f:
-            task_data = json.load(f)
+        with open(task_file, "rb") as f:
+            task_data = orjson.loads(f.read())
             for task in task_data:
                 tasks.append(
                     Task(
@@ -1,12 +1,22 @@
 import asyncio
+import shlex
+import posixpath
+import tarfile
+from io import BytesIO
 from asyncio import Lock
-from itertools import count
+from asyncio.subprocess import Process
+from uuid import uuid4
 from pathlib import Path
-from beartype import beartype
+from src.type_checking import beartype
 from dataclasses import dataclass
 from typing import List
 
-_container_creation_lock = Lock()
+# the image only needs to be built once per process, not once per sandbox
+_image_build_lock = Lock()
+_image_built = asyncio.Event()
+
+# working directory of the sandbox image, relative paths are resolved against it
+SANDBOX_HOME = "/home/sandboxuser"
 
 
 @dataclass
@@ -16,68 +26,139 @@ class CompletedProcess:
     stderr: str
 
 
+async def _read_until(
+    stream: asyncio.StreamReader, separator: bytes, max_length: int | None
+) -> bytes:
+    # reads the stream in chunks of at most the stream's limit and only keeps the first and last max_length // 2 bytes of it
+    # so that commands with huge outputs don't use up a lot of memory
+    head = bytearray()
+    tail = bytearray()
+    truncated = False
+
+    while True:
+        try:
+            data = await stream.readuntil(separator)
+            found = True
+        except asyncio.LimitOverrunError as e:
+            data = await stream.readexactly(e.consumed)
+            found = False
+        tail += data[: -len(separator)] if found else data
+
+        if max_length is not None and len(head) + len(tail) > max_length:
+            truncated = True
+            head_missing = max_length // 2 - len(head)
+            if head_missing > 0:
+                head += tail[:head_missing]
+                del tail[:head_missing]
+            del tail[: max(0, len(tail) - max_length // 2)]
+
+        if found:
+            break
+
+    if truncated:
+        return bytes(head + b"[TRUNCATED]" + tail)
+    return bytes(head + tail)
+
+
+async def _run_docker(
+    *args: str, input: bytes | None = None, max_output_length: int = 8192
+) -> tuple[int, str, str]:
+    # only the last max_output_length bytes of stdout and stderr are kept
+    # so that verbose docker commands (e.g. docker build) don't use up a lot of memory
+    proc = await asyncio.create_subprocess_exec(
+        "docker",
+        *args,
+        stdin=asyncio.subprocess.PIPE if input is not None else None,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+
+    async def write_input() -> None:
+        if input is None:
+            return
+        # like communicate, ignore docker exiting before it read all of its input, the error is then in its stderr
+        try:
+            proc.stdin.write(input)
+            await proc.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            proc.stdin.close()
+
+    async def read_tail(stream: asyncio.StreamReader) -> str:
+        tail = bytearray()
+        while chunk := await stream.read(4096):
+            tail += chunk
+            del tail[: max(0, len(tail) - max_output_length)]
+        return tail.decode("utf-8", errors="replace")
+
+    _, stdout, stderr = await asyncio.gather(
+        write_input(), read_tail(proc.stdout), read_tail(proc.stderr)
+    )
+    await proc.wait()
+    return proc.returncode, stdout, stderr
+
+
+async def _wait_for_exit(proc: Process) -> int:
+    # proc.wait() only returns once the process's pipes are closed too, which background jobs can prevent
+    # returncode is set as soon as the process exits, so we poll it instead
+    while proc.returncode is None:
+        await asyncio.sleep(0.1)
+    return proc.returncode
+
+
+async def _cancel(task: asyncio.Future) -> None:
+    # cancels the task and waits until it is done, so that it doesn't read from the shell's output anymore
+    task.cancel()
+    try:
+        await task
+    except (asyncio.CancelledError, asyncio.IncompleteReadError):
+        pass
+
+
 @beartype
 class DockerSandbox:
     container_name: str
+    shell_pid: int
+    _shell_proc: Process | None
+    _shell_lock: Lock
 
     def __init__(self):
         self.container_name = ""
+        self.shell_pid = 0
+        self._shell_proc = None
+        self._shell_lock = Lock()
 
     async def __aenter__(self):
-        async with _container_creation_lock:
-            self.container_name = await self.make_unique_container_name()
-            await self.build_image()
-            await self.start_container()
+        async with _image_build_lock:
+            if not _image_built.is_set():
+                await self.build_image()
+                _image_built.set()
+        self.container_name = self.make_unique_container_name()
+        await self.start_container()
         return self
 
     async def __aexit__(self, exc_type, exc_value, traceback):
         await self.cleanup()
 
-    async def make_unique_container_name(self) -> str:
-        proc = await asyncio.create_subprocess_exec(
-            "docker",
-            "ps",
-            "-a",
-            "--format",
-            "{{.Names}}",
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-        )
-        stdout_bytes, stderr_bytes = await proc.communicate()
-        stdout = stdout_bytes.decode("utf-8", errors="replace")
-        stderr = stderr_bytes.decode("utf-8", errors="replace")
-        if proc.returncode != 0:
-            raise Exception(f"Error getting existing containers: {stderr}")
-        existing_containers = stdout.splitlines()
-        for i in count():
-            name = f"bash-sandbox-instance-{i}"
-            if name not in existing_containers:
-                return name
+    def make_unique_container_name(self) -> str:
+        return f"bash-sandbox-instance-{uuid4().hex[:12]}"
 
     async def build_image(self) -> None:
         sandbox_path = Path("./sandbox")
         if not sandbox_path.is_dir():
             raise FileNotFoundError(f"Sandbox directory '{sandbox_path}' not found.")
-        proc = await asyncio.create_subprocess_exec(
-            "docker",
-            "build",
-            "-t",
-            "bash-sandbox",
-            str(sandbox_path),
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
+        returncode, _, stderr = await _run_docker(
+            "build", "-t", "bash-sandbox", str(sandbox_path)
         )
-        stdout_bytes, stderr_bytes = await proc.communicate()
-        stdout = stdout_bytes.decode("utf-8", errors="replace")
-        stderr = stderr_bytes.decode("utf-8", errors="replace")
-        if proc.returncode != 0:
+        if returncode != 0:
             raise Exception(f"Error building image: {stderr}")
 
     async def start_container(self) -> None:
-        proc = await asyncio.create_subprocess_exec(
-            "docker",
+        returncode, _, stderr = await _run_docker(
             "run",
             "-d",
+            "--rm",
             "--name",
             self.container_name,
             "--tty",
@@ -85,64 +166,169 @@ class DockerSandbox:
             "/bin/sh",
             "-c",
             "while true; do sleep 1; done",
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
         )
-        stdout_bytes, stderr_bytes = await proc.communicate()
-        stdout = stdout_bytes.decode("utf-8", errors="replace")
-        stderr = stderr_bytes.decode("utf-8", errors="replace")
-        if proc.returncode != 0:
+        if returncode != 0:
             raise Exception(f"Error starting container: {stderr}")
+        try:
+            await self.start_shell()
+        except BaseException:
+            # __aexit__ doesn't run if __aenter__ fails, so the container would be left running
+            await self.cleanup()
+            raise
 
-    async def run_command(
-        self, command: str, timeout_seconds: int = 30
-    ) -> CompletedProcess:
-        args = [
+    async def start_shell(self) -> None:
+        # a single long running shell which all commands are piped to, so that we don't pay for a docker exec per command
+        self._shell_proc = await asyncio.create_subprocess_exec(
             "docker",
             "exec",
+            "-i",
             self.container_name,
             "/bin/bash",
-            "-c",
-            command,
-        ]
-        proc = await asyncio.create_subprocess_exec(
-            *args,
+            stdin=asyncio.subprocess.PIPE,
             stdout=asyncio.subprocess.PIPE,
             stderr=asyncio.subprocess.PIPE,
         )
+        self._shell_proc.stdin.write(b"echo $$\n")
+        await self._shell_proc.stdin.drain()
+        pid_line = await self._shell_proc.stdout.readline()
+        if not pid_line.strip().isdigit():
+            raise Exception("Error starting shell in container.")
+        self.shell_pid = int(pid_line)
 
-        try:
-            stdout_bytes, stderr_bytes = await asyncio.wait_for(
-                proc.communicate(), timeout_seconds
+    async def stop_shell(self) -> None:
+        if self._shell_proc is None:
+            return
+        if self._shell_proc.returncode is None:
+            self._shell_proc.kill()
+        await _wait_for_exit(self._shell_proc)
+        self._shell_proc = None
+
+    async def run_command(
+        self,
+        command: str,
+        timeout_seconds: int = 30,
+        max_output_length: int | None = None,
+    ) -> CompletedProcess:
+        async with self._shell_lock:
+            if self._shell_proc is None or self._shell_proc.returncode is not None:
+                await self.stop_shell()
+                try:
+                    await self.start_shell()
+                except Exception:
+                    # e.g. the container is gone, a failed command shouldn't abort the whole evaluation
+                    await self.stop_shell()
+                    return CompletedProcess(
+                        returncode=1,
+                        stdout="",
+                        stderr="Error starting shell in container.",
+                    )
+
+            # the command is run through eval so that syntax errors (e.g. unterminated quotes) cannot swallow the sentinels
+            # the sentinels are printed with printf and without a leading newline so that the output is left untouched
+            nonce = uuid4().hex
+            self._shell_proc.stdin.write(
+                f"eval {shlex.quote(command)} < /dev/null\n"
+                f"printf '__END__{nonce}__%d\\n' $?\n"
+                f"printf '__END__{nonce}__\\n' >&2\n".encode()
+            )
+            await self._shell_proc.stdin.drain()
+
+            # the shell exiting (e.g. the command ran exit) is detected by waiting on it and not by eof on its output
+            # because background jobs started by earlier commands can keep its output open
+            shell_proc = self._shell_proc
+            read_task = asyncio.ensure_future(
+                self._read_command_output(nonce, max_output_length)
+            )
+            exit_task = asyncio.ensure_future(_wait_for_exit(shell_proc))
+            done, _ = await asyncio.wait(
+                [read_task, exit_task],
+                timeout=timeout_seconds,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+
+            if read_task in done and not isinstance(
+                read_task.exception(), asyncio.IncompleteReadError
+            ):
+                await _cancel(exit_task)
+                returncode, stdout, stderr = read_task.result()
+                return CompletedProcess(
+                    returncode=returncode, stdout=stdout, stderr=stderr
+                )
+
+            await _cancel(read_task)
+
+            if not done:
+                await _cancel(exit_task)
+                if await self._interrupt_command(nonce):
+                    return CompletedProcess(
+                        returncode=1,
+                        stdout="",
+                        stderr="Timed out. The shell was restarted; working directory and environment were reset.",
+                    )
+                return CompletedProcess(returncode=1, stdout="", stderr="Timed out.")
+
+            # the shell is restarted on the next command
+            await _cancel(exit_task)
+            await self.stop_shell()
+            return CompletedProcess(
+                returncode=shell_proc.returncode, stdout="", stderr="The shell exited."
             )
-        except asyncio.TimeoutError:
-            proc.kill()
-            await proc.wait()
-            return CompletedProcess(returncode=1, stdout="", stderr="Timed out.")
 
+    async def write_file(self, path: str, content: bytes) -> None:
+        path = posixpath.join(SANDBOX_HOME, path)
+
+        tar_bytes = BytesIO()
+        with tarfile.open(fileobj=tar_bytes, mode="w") as tar:
+            tar_info = tarfile.TarInfo(name=posixpath.basename(path))
+            tar_info.size = len(content)
+            tar.addfile(tar_info, BytesIO(content))
+
+        returncode, _, stderr = await _run_docker(
+            "cp",
+            "-",
+            f"{self.container_name}:{posixpath.dirname(path)}",
+            input=tar_bytes.getvalue(),
+        )
+        if returncode != 0:
+            raise Exception(f"Error writing file '{path}': {stderr}")
+
+    async def _read_command_output(
+        self, nonce: str, max_output_length: int | None = None
+    ) -> tuple[int, str, str]:
+        stdout_bytes, stderr_bytes = await asyncio.gather(
+            _read_until(
+                self._shell_proc.stdout,
+                f"__END__{nonce}__".encode(),
+                max_output_length,
+            ),
+            _read_until(
+                self._shell_proc.stderr,
+                f"__END__{nonce}__\n".encode(),
+                max_output_length,
+            ),
+        )
+        returncode = int(await self._shell_proc.stdout.readline())
         stdout = stdout_bytes.decode("utf-8", errors="replace")
         stderr = stderr_bytes.decode("utf-8", errors="replace")
-        return CompletedProcess(
-            returncode=proc.returncode, stdout=stdout, stderr=stderr
+        return returncode, stdout, stderr
+
+    async def _interrupt_command(self, nonce: str) -> bool:
+        # interrupt the processes the shell is waiting on rather than killing the shell
+        # if the shell doesn't get back to us (e.g. the command is a busy loop in the shell itself), restart it
+        # returns whether the shell was restarted
+        await _run_docker(
+            "exec", self.container_name, "pkill", "-INT", "-P", str(self.shell_pid)
         )
+        try:
+            await asyncio.wait_for(self._read_command_output(nonce, 0), 5)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+            await self.stop_shell()
+            return True
+        return False
 
     async def cleanup(self) -> None:
-        proc = await asyncio.create_subprocess_exec(
-            "docker",
-            "stop",
-            self.container_name,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-        )
-        await proc.communicate()
-        proc = await asyncio.create_subprocess_exec(
-            "docker",
-            "rm",
-            self.container_name,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-        )
-        await proc.communicate()
+        await self.stop_shell()
+        await _run_docker("rm", "-f", self.container_name)
 
 
 """
@@ -0,0 +1,10 @@
+from os import getenv
+import beartype as _beartype
+
+# runtime type checking adds overhead to every call, so it is only enabled with BEARTYPE=1 (e.g. when developing)
+if getenv("BEARTYPE", "0") == "1":
+    beartype = _beartype.beartype
+else:
+
+    def beartype(obj):
+        return obj